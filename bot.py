@@ -3,13 +3,18 @@
 VPN Telegram Bot Panel v2.0
 - Управление клиентами (добавить/удалить/просмотреть)
 - Лимиты: по гигабайтам и по времени (дни)
+- Прогноз расхода квоты и предупреждения администраторам
 - Ротация SNI
+- Несколько inbound'ов (порты/транспорты), распределение клиентов по нагрузке
 - Статистика трафика через Xray API
 """
 
-import os, json, logging, subprocess, io, sys, uuid
+import os, json, logging, subprocess, io, sys, uuid, time, asyncio, shlex, contextlib
+from types import MappingProxyType
+from collections import deque
 from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import quote
 
 try:
     import qrcode
@@ -35,6 +40,15 @@ BOT_DIR     = Path("/opt/vpn-bot")
 VPN_CFG     = BOT_DIR / "vpn_config.json"
 CLIENTS_FILE= BOT_DIR / "clients.json"
 XRAY_CFG    = Path("/usr/local/etc/xray/config.json")
+XRAY_API    = "127.0.0.1:10085"
+
+# Мониторинг лимитов
+WARN_PCT        = sorted(int(x) for x in os.getenv("WARN_PCT", "80,95").split(",") if x.strip().isdigit())
+WARN_EXPIRY_H   = int(os.getenv("WARN_EXPIRY_HOURS", "24"))
+CHECK_INTERVAL  = int(os.getenv("CHECK_INTERVAL", "300"))   # сек, обычная проверка
+CHECK_MIN       = 30                                        # сек, для клиентов у лимита
+ALERT_INTERVAL  = int(os.getenv("ALERT_INTERVAL", "600"))   # сек между уведомлениями
+RATE_WINDOW     = 3600                                      # сек истории для скорости
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -46,9 +60,79 @@ logger = logging.getLogger(__name__)
 # ConversationHandler states
 (ASK_NAME, ASK_LIMIT_GB, ASK_LIMIT_DAYS) = range(3)
 
+# ── Config snapshots ──────────────────────────────────────
+# Разобранные JSON-конфиги держим в памяти неизменяемыми (MappingProxyType
+# и кортежи) и перечитываем файл только при смене mtime/размера. Каждая
+# новая версия получает номер; производные значения (части VLESS-ссылки)
+# лежат в отдельном кэше и считаются один раз на набор версий.
+_snapshots: dict[Path, dict] = {}
+_derived: dict[str, tuple] = {}   # имя -> (версии конфигов, значение)
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+def _thaw(obj):
+    """Изменяемая копия замороженного снимка"""
+    if isinstance(obj, MappingProxyType):
+        return {k: _thaw(v) for k, v in obj.items()}
+    if isinstance(obj, tuple):
+        return [_thaw(v) for v in obj]
+    return obj
+
+def _file_key(path: Path) -> tuple[int, int] | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _store_snapshot(path: Path, key: tuple[int, int] | None, data: dict) -> dict:
+    prev = _snapshots.get(path)
+    snap = {
+        "key": key,
+        "version": prev["version"] + 1 if prev else 1,
+        "data": _freeze(data),
+    }
+    _snapshots[path] = snap
+    return snap
+
+def _snapshot(path: Path) -> dict:
+    snap = _snapshots.get(path)
+    key = _file_key(path)
+    if snap and snap["key"] == key:
+        return snap
+    # Ключ берём до чтения: если файл поменяют во время чтения, на следующем
+    # вызове mtime не совпадёт и файл перечитается
+    return _store_snapshot(path, key, json.loads(path.read_text()) if key else {})
+
+def _write_json(path: Path, data: dict):
+    raw = json.dumps(data, indent=2, ensure_ascii=False)
+    path.write_text(raw)
+    _store_snapshot(path, _file_key(path), data)
+
+def _cached(name: str, paths: tuple[Path, ...], build):
+    """Значение build(), пересчитываемое только при смене версий файлов paths"""
+    versions = tuple(_snapshot(p)["version"] for p in paths)
+    hit = _derived.get(name)
+    if hit and hit[0] == versions:
+        return hit[1]
+    value = build()
+    _derived[name] = (versions, value)
+    return value
+
 # ── Data helpers ──────────────────────────────────────────
-def vpn_cfg() -> dict:
-    return json.loads(VPN_CFG.read_text()) if VPN_CFG.exists() else {}
+def vpn_cfg() -> MappingProxyType:
+    """Текущая версия vpn_config.json (только чтение)"""
+    return _snapshot(VPN_CFG)["data"]
+
+def update_vpn_cfg(**changes):
+    cfg = _thaw(vpn_cfg())
+    cfg.update(changes)
+    _write_json(VPN_CFG, cfg)
 
 def load_clients() -> list:
     if not CLIENTS_FILE.exists():
@@ -79,75 +163,500 @@ def fmt_bytes(b: int) -> str:
 
 # ── Xray config management ────────────────────────────────
 def xray_config() -> dict:
-    return json.loads(XRAY_CFG.read_text())
+    """Изменяемая копия конфига Xray — для правки и save_xray_config()"""
+    snap = _snapshot(XRAY_CFG)
+    if snap["key"] is None:
+        raise FileNotFoundError(XRAY_CFG)
+    return _thaw(snap["data"])
+
+def xray_snapshot() -> MappingProxyType:
+    """Текущая версия конфига Xray (только чтение)"""
+    return _snapshot(XRAY_CFG)["data"]
 
 def save_xray_config(cfg: dict):
-    XRAY_CFG.write_text(json.dumps(cfg, indent=2, ensure_ascii=False))
+    flush_traffic()
+    _write_json(XRAY_CFG, cfg)
     run("systemctl reload xray 2>/dev/null || systemctl restart xray")
 
-def add_xray_client(user_uuid: str, email: str):
+# Клиенты распределяются по всем VLESS inbound'ам конфига Xray
+# (разные порты и транспорты: tcp / xhttp / grpc), у каждого свой список.
+def vless_inbounds(cfg: dict) -> list[dict]:
+    return [ib for ib in cfg.get("inbounds", []) if ib.get("protocol") == "vless"]
+
+def inbound_tag(ib: dict) -> str:
+    return ib.get("tag") or f"port-{ib.get('port')}"
+
+def inbound_network(ib: dict) -> str:
+    return ib.get("streamSettings", {}).get("network", "tcp")
+
+def inbound_security(ib: dict) -> str:
+    return ib.get("streamSettings", {}).get("security", "none")
+
+def inbound_flow(ib: dict) -> str:
+    """Vision работает только поверх TCP с TLS/Reality"""
+    if inbound_network(ib) == "tcp" and inbound_security(ib) in ("reality", "tls"):
+        return "xtls-rprx-vision"
+    return ""
+
+def inbound_clients(ib) -> list:
+    """Клиенты inbound'а (в добавленном вручную списка может не быть)"""
+    return ib.get("settings", {}).get("clients", [])
+
+def _build_uuid_inbounds() -> MappingProxyType:
+    index = {}
+    for ib in vless_inbounds(xray_snapshot()):
+        for c in inbound_clients(ib):
+            index.setdefault(c.get("id"), inbound_tag(ib))
+    return MappingProxyType(index)
+
+def client_inbound(user_uuid: str, tag: str | None = None) -> str | None:
+    """Тег inbound'а клиента. Без сохранённого тега (старые клиенты, владелец) —
+    inbound, в списке которого есть UUID, иначе первый VLESS inbound:
+    туда их клали install.sh и прежние версии бота"""
+    if tag:
+        return tag
+    index = _cached("uuid_inbounds", (XRAY_CFG,), _build_uuid_inbounds)
+    if user_uuid in index:
+        return index[user_uuid]
+    inbounds = vless_inbounds(xray_snapshot())
+    return inbound_tag(inbounds[0]) if inbounds else None
+
+def add_xray_client(user_uuid: str, email: str, tag: str | None = None) -> str:
+    """Добавляет клиента в inbound с тегом tag или в наименее загруженный.
+    Возвращает тег выбранного inbound'а"""
     cfg = xray_config()
-    clients = cfg["inbounds"][0]["settings"]["clients"]
-    clients.append({"id": user_uuid, "flow": "xtls-rprx-vision", "email": email})
+    # Только inbound'ы, для которых умеем строить ссылку
+    linkable = _vless_link_parts()
+    inbounds = [ib for ib in vless_inbounds(cfg) if inbound_tag(ib) in linkable]
+    if not inbounds:
+        raise RuntimeError("В конфиге Xray нет VLESS inbound'а, для которого можно построить ссылку")
+    ib = next((ib for ib in inbounds if inbound_tag(ib) == tag), None)
+    if ib is None:
+        ib = min(inbounds, key=lambda ib: len(inbound_clients(ib)))
+    entry = {"id": user_uuid, "email": email}
+    if inbound_flow(ib):
+        entry = {"id": user_uuid, "flow": inbound_flow(ib), "email": email}
+    ib.setdefault("settings", {}).setdefault("clients", []).append(entry)
     save_xray_config(cfg)
+    return inbound_tag(ib)
 
-def remove_xray_client(user_uuid: str):
+def remove_xray_client(*uuids: str):
+    """Убирает клиентов из всех inbound'ов одной записью конфига"""
     cfg = xray_config()
-    clients = cfg["inbounds"][0]["settings"]["clients"]
-    cfg["inbounds"][0]["settings"]["clients"] = [
-        c for c in clients if c.get("id") != user_uuid
-    ]
+    for ib in vless_inbounds(cfg):
+        if inbound_clients(ib):
+            ib["settings"]["clients"] = [
+                c for c in inbound_clients(ib) if c.get("id") not in uuids
+            ]
     save_xray_config(cfg)
 
-def get_xray_stats(email: str) -> tuple[int, int]:
-    """Статистика через xray API недоступна в текущей конфигурации"""
-    # Читаем сохранённые данные из clients.json
-    cl = get_client(email)
-    if cl:
-        return cl.get("used_bytes", 0), 0
-    return 0, 0
+def ensure_xray_stats():
+    """Включает в конфиге Xray счётчики трафика по пользователям и Stats API
+    (установки до появления статистики их не содержат)"""
+    try:
+        cfg = xray_config()
+    except (OSError, ValueError):
+        return
+    if "stats" in cfg and "api" in cfg:
+        return
+    host, port = XRAY_API.rsplit(":", 1)
+    cfg["stats"] = {}
+    cfg["api"] = {"tag": "api", "services": ["StatsService"]}
+    levels = cfg.setdefault("policy", {}).setdefault("levels", {})
+    levels.setdefault("0", {}).update(statsUserUplink=True, statsUserDownlink=True)
+    inbounds = cfg.setdefault("inbounds", [])
+    if not any(ib.get("tag") == "api" for ib in inbounds):
+        inbounds.append({"tag": "api", "listen": host, "port": int(port),
+                         "protocol": "dokodemo-door", "settings": {"address": host}})
+    rules = cfg.setdefault("routing", {}).setdefault("rules", [])
+    if not any(r.get("outboundTag") == "api" for r in rules):
+        rules.insert(0, {"type": "field", "inboundTag": ["api"], "outboundTag": "api"})
+    save_xray_config(cfg)
+    logger.info("В конфиг Xray добавлена статистика трафика")
+
+def poll_xray_stats() -> dict[str, tuple[int, int]]:
+    """Трафик пользователей с прошлого опроса: email -> (uplink, downlink).
+    Счётчики Xray при этом обнуляются (-reset) и сбрасываются при его рестарте,
+    поэтому накопленный итог хранится в clients.json"""
+    ok, out = run(f"xray api statsquery --server={XRAY_API} -pattern 'user>>>' -reset")
+    if not ok:
+        logger.warning(f"Статистика Xray недоступна: {out}")
+        return {}
+    try:
+        stats = json.loads(out).get("stat", [])
+    except ValueError:
+        return {}
+    traffic: dict[str, tuple[int, int]] = {}
+    for st in stats:
+        # user>>>{email}>>>traffic>>>uplink|downlink; нулевой value Xray не выводит
+        parts = st.get("name", "").split(">>>")
+        if len(parts) != 4 or parts[0] != "user":
+            continue
+        up, dn = traffic.get(parts[1], (0, 0))
+        val = int(st.get("value", 0))
+        traffic[parts[1]] = (up + val, dn) if parts[3] == "uplink" else (up, dn + val)
+    return traffic
+
+def collect_traffic(clients: list) -> bool:
+    """Прибавляет к счётчикам клиентов трафик из Xray. True — если что-то изменилось"""
+    traffic = poll_xray_stats()
+    changed = False
+    for c in clients:
+        up, dn = traffic.get(c["name"], (0, 0))
+        if up or dn:
+            c["up_bytes"] = c.get("up_bytes", 0) + up
+            c["used_bytes"] = c.get("used_bytes", 0) + up + dn
+            changed = True
+    return changed
+
+def flush_traffic():
+    """Сохраняет ещё не снятый трафик: счётчики Xray живут в памяти и теряются
+    при его рестарте. Вызывать под _data_lock перед записью конфига Xray,
+    рестартом или остановкой"""
+    clients = load_clients()
+    if collect_traffic(clients):
+        save_clients(clients)
 
-def build_vless_link(user_uuid: str, name: str) -> str:
-    c = vpn_cfg()
-    sni = c.get("chosen_sni","")
+def xray_service(action: str) -> tuple[bool, str]:
+    if action in ("restart", "stop"):
+        flush_traffic()
+    return run(f"systemctl {action} xray")
+
+def get_xray_stats(cl: dict) -> tuple[int, int]:
+    """Накопленный трафик клиента (отправлено, получено) из clients.json"""
+    up = cl.get("up_bytes", 0)
+    return up, cl.get("used_bytes", 0) - up
+
+def _reality_public_key(rs: dict, c: dict) -> str | None:
+    """Публичный ключ Reality для inbound'а: общий из vpn_config.json
+    или вычисленный из собственного privateKey inbound'а"""
+    priv = rs.get("privateKey")
+    if not priv or priv == c.get("private_key"):
+        return c.get("public_key")
+    ok, out = run(f"xray x25519 -i {shlex.quote(priv)}")
+    if not ok:
+        return None
+    # Новый формат (v26+): Password / старый: Public key
+    for line in out.splitlines():
+        key, _, val = line.partition(":")
+        if key.strip().lower().startswith(("password", "public key")):
+            return val.strip()
+    return None
+
+def _inbound_link_params(ib: dict, c: dict) -> str | None:
+    """Параметры ссылки для inbound'а или None, если его не описать ссылкой.
+    SNI и short ID Reality берутся из vpn_config.json, если inbound их принимает"""
+    ss  = ib.get("streamSettings", {})
+    net = inbound_network(ib)
+    sec = inbound_security(ib)
+    if net not in ("tcp", "xhttp", "grpc") or sec not in ("reality", "tls", "none"):
+        return None
+    params = "encryption=none"
+    if inbound_flow(ib): params += f"&flow={inbound_flow(ib)}"
+    params += f"&security={sec}"
+    sni = ""
+    if sec == "reality":
+        rs  = ss.get("realitySettings", {})
+        pbk = _reality_public_key(rs, c)
+        if not pbk:
+            return None
+        names = rs.get("serverNames") or []
+        sids  = rs.get("shortIds") or [c.get("short_id", "")]
+        sni = c.get("chosen_sni","")
+        if names and sni not in names: sni = names[0]
+        sid = c.get("short_id","")
+        if sid not in sids: sid = sids[0]
+        params += f"&pbk={pbk}&sid={sid}"
+    elif sec == "tls":
+        sni = ss.get("tlsSettings", {}).get("serverName", "")
+    params += f"&type={net}"
+    if net == "tcp":
+        params += "&headerType=none"
+    elif net == "xhttp":
+        params += "&path=" + quote(ss.get("xhttpSettings", {}).get("path", "/"), safe="")
+    elif net == "grpc":
+        params += "&serviceName=" + quote(ss.get("grpcSettings", {}).get("serviceName", ""), safe="")
     fp  = c.get("fingerprint","")
-    params = f"encryption=none&flow=xtls-rprx-vision&security=reality&pbk={c['public_key']}&sid={c['short_id']}&type=tcp&headerType=none"
     if sni: params += f"&sni={sni}"
-    if fp:  params += f"&fp={fp}"
-    tag = name.replace(" ", "_")
-    return f"vless://{user_uuid}@{c['public_ip']}:{c['port']}?{params}#{tag}"
+    if fp and sec != "none": params += f"&fp={fp}"
+    return params
+
+def _vless_link_parts() -> MappingProxyType:
+    """Адрес и параметры ссылки по тегам inbound'ов — считаются один раз
+    на пару версий vpn_config.json / конфига Xray"""
+    return _cached("link_parts", (VPN_CFG, XRAY_CFG), _build_link_parts)
 
-def check_client_limits():
-    """Проверяет и отключает клиентов с превышением лимитов"""
+def _build_link_parts() -> MappingProxyType:
+    c = vpn_cfg()
+    inbounds = vless_inbounds(xray_snapshot())
+    if not inbounds:
+        # Без конфига Xray — ссылка на основной порт из vpn_config.json
+        ib = {"port": c["port"], "streamSettings": {"network": "tcp", "security": "reality"}}
+        return MappingProxyType({None: (f"@{c['public_ip']}:{c['port']}?", _inbound_link_params(ib, c) + "#")})
+    parts = {}
+    for ib in inbounds:
+        params = _inbound_link_params(ib, c)
+        if params is None:
+            logger.warning(f"Inbound {inbound_tag(ib)}: {inbound_network(ib)}/{inbound_security(ib)} "
+                           f"не описывается ссылкой, клиенты туда не назначаются")
+            continue
+        parts[inbound_tag(ib)] = (f"@{c['public_ip']}:{ib.get('port')}?", params + "#")
+    return MappingProxyType(parts)
+
+def build_vless_link(user_uuid: str, name: str, inbound: str | None = None) -> str:
+    parts = _vless_link_parts()
+    tag = client_inbound(user_uuid, inbound)
+    if tag not in parts:
+        raise RuntimeError(f"Нет ссылки для inbound'а {tag}: "
+                           f"он удалён из конфига Xray или не поддерживается")
+    host, params = parts[tag]
+    return "vless://" + user_uuid + host + params + name.replace(" ", "_")
+
+def port_connections() -> dict[int, int]:
+    """Число установленных TCP-соединений по локальным портам"""
+    _, out = run("ss -tnH state established")
+    conns: dict[int, int] = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) >= 3 and parts[2].rsplit(":", 1)[-1].isdigit():
+            port = int(parts[2].rsplit(":", 1)[-1])
+            conns[port] = conns.get(port, 0) + 1
+    return conns
+
+def inbound_stats(clients: list) -> list[dict]:
+    """Клиенты, трафик и соединения по каждому inbound'у"""
+    conns = port_connections()
+    stats = []
+    for ib in vless_inbounds(xray_snapshot()):
+        tag = inbound_tag(ib)
+        mine = [cl for cl in clients if client_inbound(cl["uuid"], cl.get("inbound")) == tag]
+        stats.append({
+            "tag": tag,
+            "port": ib.get("port"),
+            "network": inbound_network(ib),
+            "clients": sum(1 for cl in mine if cl.get("active", True)),
+            "used_bytes": sum(sum(get_xray_stats(cl)) for cl in mine),
+            "conns": conns.get(ib.get("port"), 0),
+        })
+    return stats
+
+# ── Client operations ─────────────────────────────────────
+# Работа с clients.json и конфигом Xray блокирует (файлы, systemctl, xray api),
+# поэтому обработчики выполняют её в потоке через locked_call(). Блокировка
+# не даёт обработчикам и проверке лимитов затереть изменения друг друга.
+_data_lock = asyncio.Lock()
+
+async def locked_call(fn, *args):
+    async with _data_lock:
+        return await asyncio.to_thread(fn, *args)
+
+def register_client(name: str, limit_gb: int, expires: str | None) -> tuple[str, str]:
+    """Заводит клиента в Xray и clients.json. Возвращает (inbound, ссылка)"""
+    new_uuid = str(uuid.uuid4())
+    tag = add_xray_client(new_uuid, name)
+    client = {
+        "name": name,
+        "uuid": new_uuid,
+        "inbound": tag,
+        "active": True,
+        "created": datetime.now().isoformat(),
+        "limit_gb": limit_gb or None,
+        "expires": expires,
+        "used_bytes": 0
+    }
     clients = load_clients()
-    changed = False
+    clients.append(client)
+    save_clients(clients)
+    return tag, build_vless_link(new_uuid, name, tag)
+
+def delete_client(name: str):
+    cl = get_client(name)
+    if cl:
+        remove_xray_client(cl["uuid"])
+        save_clients([c for c in load_clients() if c["name"] != name])
+
+def apply_sni(new_sni: str) -> bool:
+    """Меняет SNI во всех Reality inbound'ах и в vpn_config.json, перезапускает Xray"""
+    xray_cfg = xray_config()
+    for ib in vless_inbounds(xray_cfg):
+        rs = ib.get("streamSettings", {}).get("realitySettings")
+        if rs is None:
+            continue
+        if new_sni:
+            rs["dest"] = f"{new_sni}:443"
+            rs["serverNames"] = [new_sni]
+        else:
+            rs["dest"] = "www.microsoft.com:443"
+            rs["serverNames"] = []
+    save_xray_config(xray_cfg)
+    update_vpn_cfg(chosen_sni=new_sni,
+                   dest=f"{new_sni}:443" if new_sni else "www.microsoft.com:443")
+    ok, _ = xray_service("restart")
+    return ok
+
+# ── Quota monitoring ──────────────────────────────────────
+# Периодически снимаем счётчики трафика, по ним считаем скорость расхода
+# и прогнозируем, когда клиент упрётся в лимит. Предупреждения копятся
+# в очереди и уходят админам пачкой не чаще раза в ALERT_INTERVAL.
+_samples: dict[str, deque] = {}      # name -> (time, used_bytes)
+_next_check: dict[str, float] = {}   # name -> время следующей проверки
+_alerts: list[str] = []
+_last_alert = 0.0
+
+def record_usage(name: str, used: int, now: float):
+    q = _samples.setdefault(name, deque())
+    if q and used < q[-1][1]:
+        q.clear()  # счётчик сброшен
+    q.append((now, used))
+    while len(q) > 2 and now - q[1][0] >= RATE_WINDOW:
+        q.popleft()
+
+def burn_rate(name: str) -> float:
+    """Скорость расхода трафика, байт/сек (0 — если данных мало)"""
+    q = _samples.get(name)
+    if not q or len(q) < 2 or q[-1][0] <= q[0][0]:
+        return 0.0
+    return (q[-1][1] - q[0][1]) / (q[-1][0] - q[0][0])
+
+def eta_to_limit(cl: dict) -> float | None:
+    """Через сколько секунд клиент исчерпает лимит трафика при текущей скорости"""
+    rate = burn_rate(cl["name"])
+    if not cl.get("limit_gb") or rate <= 0:
+        return None
+    return max(0.0, (cl["limit_gb"] * 1_073_741_824 - cl.get("used_bytes", 0)) / rate)
+
+def fmt_eta(sec: float) -> str:
+    if sec >= 86400: return f"{sec/86400:.0f} дн."
+    if sec >= 3600:  return f"{sec/3600:.0f} ч"
+    return f"{max(1, sec/60):.0f} мин"
+
+def check_client_limits(due_only: bool = False) -> float:
+    """Проверяет и отключает клиентов с превышением лимитов, ставит в очередь
+    предупреждения. Возвращает, через сколько секунд нужна следующая проверка"""
+    clients = load_clients()
+    changed = collect_traffic(clients)
+    removed = []
+    now = time.time()
     for c in clients:
         if not c.get("active", True):
             continue
+        name = c["name"]
+        if due_only and _next_check.get(name, 0) > now:
+            continue
+        interval = CHECK_INTERVAL
+        warned = c.setdefault("warned", [])
         # Лимит по времени
         if c.get("expires"):
             exp = datetime.fromisoformat(c["expires"])
             if datetime.now() > exp:
                 c["active"] = False
                 c["disabled_reason"] = "expired"
-                remove_xray_client(c["uuid"])
+                removed.append(c["uuid"])
                 changed = True
-                logger.info(f"Отключён {c['name']} — истёк срок")
+                logger.info(f"Отключён {name} — истёк срок")
+                _alerts.append(f"🔴 {name} отключён — истёк срок")
                 continue
+            left = (exp - datetime.now()).total_seconds()
+            if left > WARN_EXPIRY_H * 3600 and "expiry" in warned:
+                warned.remove("expiry")  # срок продлён
+                changed = True
+            if left <= WARN_EXPIRY_H * 3600 and "expiry" not in warned:
+                warned.append("expiry")
+                changed = True
+                _alerts.append(f"⏳ {name}: срок истекает через {fmt_eta(left)} ({c['expires'][:10]})")
+            interval = min(interval, max(1.0, left))
         # Лимит по трафику
         if c.get("limit_gb"):
-            up, dn = get_xray_stats(c["name"])
-            total = up + dn
-            c["used_bytes"] = total
+            total = c.get("used_bytes", 0)
+            record_usage(name, total, now)
             limit_bytes = c["limit_gb"] * 1_073_741_824
             if total >= limit_bytes:
                 c["active"] = False
                 c["disabled_reason"] = "traffic_exceeded"
-                remove_xray_client(c["uuid"])
+                removed.append(c["uuid"])
+                changed = True
+                logger.info(f"Отключён {name} — превышен лимит трафика")
+                _alerts.append(f"🔴 {name} отключён — превышен лимит трафика")
+                continue
+            pct = total * 100 / limit_bytes
+            # Счётчик сброшен или лимит увеличен — пороги выше текущего снова актуальны
+            kept = [w for w in warned if w == "expiry" or pct >= int(w)]
+            if len(kept) != len(warned):
+                warned[:] = kept
                 changed = True
-                logger.info(f"Отключён {c['name']} — превышен лимит трафика")
+            crossed = [t for t in WARN_PCT if pct >= t and str(t) not in warned]
+            if crossed:
+                # За одну проверку могли проскочить несколько порогов — сообщаем о старшем
+                warned.extend(str(t) for t in crossed)
+                changed = True
+                eta = eta_to_limit(c)
+                msg = f"⚠️ {name}: {int(pct)}% трафика ({fmt_bytes(total)} / {c['limit_gb']} ГБ)"
+                if eta is not None:
+                    msg += f", лимит ≈ через {fmt_eta(eta)}"
+                _alerts.append(msg)
+            # Чем ближе следующий порог при текущей скорости, тем чаще проверяем
+            rate = burn_rate(name)
+            if rate > 0:
+                nxt = next((t for t in WARN_PCT if str(t) not in warned and t > pct), 100)
+                interval = min(interval, (limit_bytes * nxt / 100 - total) / rate / 2)
+        _next_check[name] = now + max(CHECK_MIN, interval)
     if changed:
         save_clients(clients)
+    if removed:
+        remove_xray_client(*removed)
+    active = {c["name"] for c in clients if c.get("active", True)}
+    pending = [t for n, t in _next_check.items() if n in active]
+    return max(CHECK_MIN, min(pending, default=now + CHECK_INTERVAL) - now)
+
+async def run_limits_check(due_only: bool = False) -> float:
+    """check_client_limits() вне цикла событий: внутри чтение файлов,
+    опрос Xray и его перезагрузка"""
+    return await locked_call(check_client_limits, due_only)
+
+async def flush_alerts(bot) -> float:
+    """Отправляет накопленные предупреждения (длинную пачку — несколькими
+    сообщениями). Возвращает, через сколько секунд можно отправить следующую"""
+    global _last_alert
+    wait = _last_alert + ALERT_INTERVAL - time.time()
+    if not _alerts or wait > 0:
+        return max(wait, 0) if _alerts else float("inf")
+    batch = _alerts[:]
+    del _alerts[:len(batch)]
+    _last_alert = time.time()
+    messages, text = [], "🔔 Лимиты клиентов\n"
+    for line in batch:
+        if len(text) + len(line) + 1 > 4000:
+            messages.append(text)
+            text = "🔔 Лимиты клиентов (продолжение)\n"
+        text += "\n" + line
+    messages.append(text)
+    for uid in ADMIN_IDS:
+        for text in messages:
+            try:
+                await bot.send_message(chat_id=uid, text=text)
+            except Exception as e:
+                logger.warning(f"Не удалось отправить уведомление {uid}: {e}")
+    return float("inf")
+
+async def limits_loop(app: Application):
+    while True:
+        delay = CHECK_INTERVAL
+        try:
+            delay = await run_limits_check(due_only=True)
+            delay = min(delay, await flush_alerts(app.bot))
+        except Exception as e:
+            logger.error(f"Ошибка проверки лимитов: {e}")
+        await asyncio.sleep(max(1.0, delay))
+
+async def start_monitor(app: Application):
+    app.bot_data["limits_task"] = asyncio.create_task(limits_loop(app))
+
+async def stop_monitor(app: Application):
+    task = app.bot_data.pop("limits_task", None)
+    if task:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
 
 # ── Keyboards ─────────────────────────────────────────────
 def main_kb() -> InlineKeyboardMarkup:
@@ -190,8 +699,7 @@ def client_action_kb(name: str) -> InlineKeyboardMarkup:
     ])
 
 def sni_kb() -> InlineKeyboardMarkup:
-    c = vpn_cfg()
-    working = c.get("working_snis", [])
+    working = vpn_cfg().get("working_snis", ())
     btns = []
     for sni in working[:6]:
         btns.append([InlineKeyboardButton(f"🌐 {sni}", callback_data=f"set_sni:{sni}")])
@@ -209,7 +717,7 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
         return
     # Проверяем лимиты при каждом старте
-    check_client_limits()
+    await run_limits_check()
     c = vpn_cfg()
     await update.message.reply_text(
         f"👋 *Панель управления VPN*\n\n"
@@ -230,7 +738,7 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     c = vpn_cfg()
 
     if d == "back_main":
-        check_client_limits()
+        await run_limits_check()
         await q.edit_message_text(
             f"🏠 *Главное меню*\n👥 Клиентов: {len(load_clients())}",
             parse_mode="Markdown", reply_markup=main_kb()
@@ -249,10 +757,15 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         # Трафик через API
         total_up = total_dn = 0
         for cl in clients:
-            up, dn = get_xray_stats(cl["name"])
+            up, dn = get_xray_stats(cl)
             total_up += up
             total_dn += dn
 
+        shards = ""
+        for st in inbound_stats(clients):
+            shards += (f"  `{st['tag']}` :{st['port']} {st['network']} — "
+                       f"👥 {st['clients']}, 🔌 {st['conns']}, 📶 {fmt_bytes(st['used_bytes'])}\n")
+
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔄 Обновить", callback_data="status")],
             [InlineKeyboardButton("🔙 Назад", callback_data="back_main")]
@@ -266,13 +779,18 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             f"👥 Клиентов: {active}/{len(clients)} активных\n"
             f"📶 Всего трафика:\n"
             f"  ↑ {fmt_bytes(total_up)}  ↓ {fmt_bytes(total_dn)}\n\n"
+            f"📥 *Inbound'ы:*\n{shards}\n"
             f"_Обновлено: {datetime.now().strftime('%H:%M:%S')}_",
             parse_mode="Markdown", reply_markup=kb
         )
 
     # ── МОЙ КОНФИГ (для владельца) ──
     elif d == "my_config":
-        link = build_vless_link(c.get("uuid",""), "My-VPN")
+        try:
+            link = await asyncio.to_thread(build_vless_link, c.get("uuid",""), "My-VPN")
+        except RuntimeError as e:
+            await q.edit_message_text(f"❌ {e}", reply_markup=back_kb())
+            return
         await q.edit_message_text(
             f"📡 *Ваши данные*\n\n"
             f"IP: `{c.get('public_ip')}:{c.get('port')}`\n"
@@ -286,7 +804,11 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
 
     elif d == "my_qr":
-        link = build_vless_link(c.get("uuid",""), "My-VPN")
+        try:
+            link = await asyncio.to_thread(build_vless_link, c.get("uuid",""), "My-VPN")
+        except RuntimeError as e:
+            await q.edit_message_text(f"❌ {e}", reply_markup=back_kb())
+            return
         await q.edit_message_text("⏳ Генерирую QR...")
         await send_qr(ctx, q.message.chat_id, link, "📲 *Ваш QR-код*\n\nОткройте Hiddify → + → Сканировать")
 
@@ -310,7 +832,7 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             status = "🟢" if cl.get("active", True) else "🔴"
             label = f"{status} {cl['name']}"
             if cl.get("limit_gb"):
-                up, dn = get_xray_stats(cl["name"])
+                up, dn = get_xray_stats(cl)
                 used_gb = (up + dn) / 1_073_741_824
                 label += f" ({used_gb:.1f}/{cl['limit_gb']} ГБ)"
             elif cl.get("expires"):
@@ -331,16 +853,20 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not cl:
             await q.edit_message_text("❌ Клиент не найден", reply_markup=back_kb())
             return
-        up, dn = get_xray_stats(name)
+        up, dn = get_xray_stats(cl)
         status = "🟢 Активен" if cl.get("active", True) else f"🔴 Отключён ({cl.get('disabled_reason','')})"
         info = f"👤 *{name}*\n\nСтатус: {status}\n"
         if cl.get("limit_gb"):
             pct = min(100, int((up+dn) / (cl['limit_gb'] * 1_073_741_824) * 100))
             bar = "█" * (pct // 10) + "░" * (10 - pct // 10)
             info += f"Трафик: {fmt_bytes(up+dn)} / {cl['limit_gb']} ГБ\n`{bar}` {pct}%\n"
+            eta = eta_to_limit(cl)
+            if eta is not None:
+                info += f"Прогноз: лимит через ~{fmt_eta(eta)} ({fmt_bytes(int(burn_rate(name)*3600))}/ч)\n"
         if cl.get("expires"):
             days_left = (datetime.fromisoformat(cl["expires"]) - datetime.now()).days
             info += f"Истекает: {cl['expires'][:10]} (через {max(0,days_left)} дн.)\n"
+        info += f"Inbound: `{client_inbound(cl['uuid'], cl.get('inbound'))}`\n"
         info += f"\nUUID: `{cl['uuid']}`"
         await q.edit_message_text(info, parse_mode="Markdown", reply_markup=client_action_kb(name))
 
@@ -350,7 +876,11 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not cl:
             await q.edit_message_text("❌ Не найден")
             return
-        link = build_vless_link(cl["uuid"], name)
+        try:
+            link = await asyncio.to_thread(build_vless_link, cl["uuid"], name, cl.get("inbound"))
+        except RuntimeError as e:
+            await q.edit_message_text(f"❌ {e}", reply_markup=client_action_kb(name))
+            return
         await q.edit_message_text("⏳")
         await send_qr(ctx, q.message.chat_id, link, f"📲 QR для *{name}*")
 
@@ -360,7 +890,11 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not cl:
             await q.edit_message_text("❌")
             return
-        link = build_vless_link(cl["uuid"], name)
+        try:
+            link = await asyncio.to_thread(build_vless_link, cl["uuid"], name, cl.get("inbound"))
+        except RuntimeError as e:
+            await q.edit_message_text(f"❌ {e}", reply_markup=client_action_kb(name))
+            return
         await q.edit_message_text(
             f"🔗 *Ссылка для {name}:*\n\n`{link}`",
             parse_mode="Markdown", reply_markup=client_action_kb(name)
@@ -372,7 +906,7 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not cl:
             await q.edit_message_text("❌")
             return
-        up, dn = get_xray_stats(name)
+        up, dn = get_xray_stats(cl)
         await q.edit_message_text(
             f"📊 *Трафик {name}:*\n\n"
             f"↑ Отправлено: {fmt_bytes(up)}\n"
@@ -384,16 +918,11 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     elif d.startswith("client_del:"):
         name = d.split(":", 1)[1]
-        cl = get_client(name)
-        if cl:
-            remove_xray_client(cl["uuid"])
-            clients = [c for c in load_clients() if c["name"] != name]
-            save_clients(clients)
+        await locked_call(delete_client, name)
         await q.edit_message_text(f"🗑 Клиент *{name}* удалён.", parse_mode="Markdown", reply_markup=clients_kb())
 
     # ── SNI РОТАЦИЯ ──
     elif d == "sni_menu":
-        c = vpn_cfg()
         current = c.get("chosen_sni") or "пустой"
         await q.edit_message_text(
             f"🔄 *Ротация SNI*\n\n"
@@ -407,22 +936,7 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif d.startswith("set_sni:"):
         new_sni = d.split(":", 1)[1]
         await q.edit_message_text("⏳ Меняю SNI и перезапускаю Xray...")
-        # Обновляем xray config
-        xray_cfg = xray_config()
-        rs = xray_cfg["inbounds"][0]["streamSettings"]["realitySettings"]
-        if new_sni:
-            rs["dest"] = f"{new_sni}:443"
-            rs["serverNames"] = [new_sni]
-        else:
-            rs["dest"] = "www.microsoft.com:443"
-            rs["serverNames"] = []
-        save_xray_config(xray_cfg)
-        # Обновляем vpn_config
-        vpn = vpn_cfg()
-        vpn["chosen_sni"] = new_sni
-        vpn["dest"] = f"{new_sni}:443" if new_sni else "www.microsoft.com:443"
-        VPN_CFG.write_text(json.dumps(vpn, indent=2))
-        ok, _ = run("systemctl restart xray")
+        ok = await locked_call(apply_sni, new_sni)
         status = "✅ Xray перезапущен" if ok else "❌ Ошибка перезапуска"
         await q.edit_message_text(
             f"🌐 SNI изменён на: `{new_sni or 'пустой'}`\n{status}\n\n"
@@ -439,16 +953,16 @@ async def btn(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
     elif d == "restart_xray":
         await q.edit_message_text("⏳ Перезапуск...")
-        ok, _ = run("systemctl restart xray")
+        ok, _ = await locked_call(xray_service, "restart")
         await q.edit_message_text(
             "✅ Xray перезапущен" if ok else "❌ Ошибка",
             reply_markup=manage_kb()
         )
     elif d == "stop_xray":
-        run("systemctl stop xray")
+        await locked_call(xray_service, "stop")
         await q.edit_message_text("⏹ Xray остановлен", reply_markup=manage_kb())
     elif d == "start_xray":
-        run("systemctl start xray")
+        await locked_call(xray_service, "start")
         await q.edit_message_text("▶️ Xray запущен", reply_markup=manage_kb())
     elif d == "logs":
         _, logs = run("journalctl -u xray -n 25 --no-pager --output=short")
@@ -578,30 +1092,22 @@ async def create_client(q, ctx):
     limit_gb = ctx.user_data.get("limit_gb", 0)
     limit_days = ctx.user_data.get("limit_days", 0)
 
-    new_uuid = str(uuid.uuid4())
     expires  = None
     if limit_days:
         expires = (datetime.now() + timedelta(days=limit_days)).isoformat()
 
-    client = {
-        "name": name,
-        "uuid": new_uuid,
-        "active": True,
-        "created": datetime.now().isoformat(),
-        "limit_gb": limit_gb or None,
-        "expires": expires,
-        "used_bytes": 0
-    }
-    clients = load_clients()
-    clients.append(client)
-    save_clients(clients)
-    add_xray_client(new_uuid, name)
+    try:
+        tag, link = await locked_call(register_client, name, limit_gb, expires)
+    except RuntimeError as e:
+        await q.edit_message_text(f"❌ {e}", reply_markup=clients_kb())
+        ctx.user_data.clear()
+        return ConversationHandler.END
 
-    link = build_vless_link(new_uuid, name)
     info = (
         f"✅ *Клиент создан: {name}*\n\n"
         f"Лимит трафика: {'∞' if not limit_gb else str(limit_gb)+' ГБ'}\n"
-        f"Срок: {'∞' if not expires else expires[:10]}\n\n"
+        f"Срок: {'∞' if not expires else expires[:10]}\n"
+        f"Inbound: `{tag}`\n\n"
         f"🔗 Ссылка:\n`{link}`\n\n"
         f"_QR-код — в меню клиента_"
     )
@@ -614,22 +1120,17 @@ async def create_client_msg(msg, ctx):
     limit_gb = ctx.user_data.get("limit_gb", 0)
     limit_days = ctx.user_data.get("limit_days", 0)
 
-    new_uuid = str(uuid.uuid4())
     expires  = None
     if limit_days:
         expires = (datetime.now() + timedelta(days=limit_days)).isoformat()
 
-    client = {
-        "name": name, "uuid": new_uuid, "active": True,
-        "created": datetime.now().isoformat(),
-        "limit_gb": limit_gb or None, "expires": expires, "used_bytes": 0
-    }
-    clients = load_clients()
-    clients.append(client)
-    save_clients(clients)
-    add_xray_client(new_uuid, name)
+    try:
+        tag, link = await locked_call(register_client, name, limit_gb, expires)
+    except RuntimeError as e:
+        await msg.reply_text(f"❌ {e}", reply_markup=main_kb())
+        ctx.user_data.clear()
+        return ConversationHandler.END
 
-    link = build_vless_link(new_uuid, name)
     await msg.reply_text(
         f"✅ *{name}* создан!\n"
         f"Лимит: {'∞' if not limit_gb else str(limit_gb)+' ГБ'}\n"
@@ -669,7 +1170,8 @@ def main():
         logger.error("BOT_TOKEN не установлен!")
         sys.exit(1)
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    ensure_xray_stats()
+    app = Application.builder().token(BOT_TOKEN).post_init(start_monitor).post_shutdown(stop_monitor).build()
 
     # ConversationHandler для добавления клиента
     conv = ConversationHandler(
@@ -158,6 +158,11 @@ mkdir -p /usr/local/etc/xray /var/log/xray
 cat > "$XRAY_CONFIG" <<EOF
 {
   "log": { "loglevel": "warning" },
+  "stats": {},
+  "api": { "tag": "api", "services": ["StatsService"] },
+  "policy": {
+    "levels": { "0": { "statsUserUplink": true, "statsUserDownlink": true } }
+  },
   "inbounds": [
     {
       "tag": "vless-in",
@@ -177,6 +182,13 @@ cat > "$XRAY_CONFIG" <<EOF
         }
       },
       "sniffing": { "enabled": true, "destOverride": ["http", "tls", "quic"] }
+    },
+    {
+      "tag": "api",
+      "listen": "127.0.0.1",
+      "port": 10085,
+      "protocol": "dokodemo-door",
+      "settings": { "address": "127.0.0.1" }
     }
   ],
   "outbounds": [
@@ -184,7 +196,9 @@ cat > "$XRAY_CONFIG" <<EOF
     { "protocol": "blackhole", "tag": "block" }
   ],
   "routing": {
-    "rules": []
+    "rules": [
+      { "type": "field", "inboundTag": ["api"], "outboundTag": "api" }
+    ]
   }
 }
 EOF